@@ -3,7 +3,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Dict, Any
 from contextlib import asynccontextmanager
-from mcp_client import MCPClient
+from mcp_client import MCPClient, TOOL_CACHE_TTL
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
 
@@ -18,7 +18,8 @@ class Settings(BaseSettings):
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    client = MCPClient()
+    # chatbot only answers questions, so repeated calls can reuse its result
+    client = MCPClient(cacheable_tools={"chatbot": TOOL_CACHE_TTL})
     try:
         connected = await client.connect_to_server(settings.server_script_path)
         if not connected:
@@ -79,7 +80,7 @@ async def test():
 async def get_tools():
     """Get the list of available tools"""
     try:
-        tools = await app.state.client.get_mcp_tools()
+        tools = (await app.state.client.session.list_tools()).tools
         return {
             "tools": [
                 {
@@ -1,23 +1,179 @@
 from typing import Optional
+import asyncio
 from contextlib import AsyncExitStack
-import traceback
+from datetime import timedelta
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
-from datetime import datetime
+from mcp.shared.exceptions import McpError
 from utils.logger import logger
-import json
+from utils.cache import LRUCache
+from utils.conversation_log import encode_frame
+from hashlib import blake2b
+from functools import partial
+import msgspec
 import os
-from openai import OpenAI
+import random
+import time
+import httpx
+from openai import AsyncOpenAI
+
+# upper bound on tool calls in flight at once for a single LLM turn
+MAX_CONCURRENT_TOOL_CALLS = 8
+# seconds to wait for a tool result before the call fails with a timeout
+TOOL_CALL_TIMEOUT = 60.0
+# attempts per call to an idempotent tool when the request times out
+TOOL_CALL_ATTEMPTS = 4
+# number of LLM responses kept for identical (model, tools, messages) requests
+LLM_CACHE_SIZE = 256
+LLM_MODEL = "gpt-4o"
+# results of cacheable tools are reused for identical (tool_name, args) calls
+# within the tool's TTL; TOOL_CACHE_TTL is a sensible TTL for read-only tools
+TOOL_CACHE_SIZE = 512
+TOOL_CACHE_TTL = 300.0
+
+# older tool rounds are summarized once the history grows past this many tokens
+HISTORY_TOKEN_LIMIT = 8000
+SUMMARY_MODEL = "gpt-4o-mini"
+
+class FunctionCall(msgspec.Struct, frozen=True):
+    name: str
+    arguments: str
+
+
+class ToolCall(msgspec.Struct, frozen=True, tag="function", tag_field="type"):
+    id: str
+    function: FunctionCall
+
+
+class Message(msgspec.Struct, frozen=True, tag_field="role"):
+    """A conversation message; the role is encoded as the struct tag."""
+
+
+class SystemMessage(Message, tag="system"):
+    content: str
+
+
+class UserMessage(Message, tag="user"):
+    content: str
+
+
+class AssistantMessage(Message, tag="assistant"):
+    content: str | None = None
+    tool_calls: tuple[ToolCall, ...] | msgspec.UnsetType = msgspec.UNSET
+
+
+class ToolMessage(Message, tag="tool"):
+    tool_call_id: str
+    content: str
+
+
+class LogRecord(msgspec.Struct):
+    """A message as written to the conversation log."""
+
+    message: Message
+    # wall-clock time the message was added, in nanoseconds since the epoch
+    ts: int
+
+
+class Conversation:
+    """The messages of a single process_query call.
+
+    Each query gets its own conversation so concurrent queries on one client
+    never share history. payload holds each message in the API's dict form,
+    converted once when the message is added; log_tail holds records not yet
+    handed to the writer.
+    """
+
+    def __init__(self, messages=()):
+        self.messages = list(messages)
+        self.payload = [msgspec.to_builtins(message) for message in self.messages]
+        self.log_tail = []
+
+    def append(self, message):
+        self.insert(len(self.messages), message)
+
+    def insert(self, index, message):
+        self.messages.insert(index, message)
+        self.payload.insert(index, msgspec.to_builtins(message))
+        self.log_tail.append(LogRecord(message, time.time_ns()))
+
+    def remove(self, start, stop):
+        del self.messages[start:stop]
+        del self.payload[start:stop]
+
+
+# kept constant so every request starts with the same prefix as the last one
+SYSTEM_MESSAGE = SystemMessage(
+    "You are a helpful assistant connected to an MCP server. "
+    "Use the available tools whenever they can answer the user's question "
+    "more accurately than you can on your own, and call independent tools "
+    "in parallel. When a tool returns an error, explain the problem to the "
+    "user instead of retrying the same call. Base your final answer on the "
+    "tool results and keep it concise."
+)
+
+
+# rough token count (about 4 characters per token) used to decide when to summarize
+def estimate_tokens(messages) -> int:
+    chars = 0
+    for message in messages:
+        chars += len(message.content or "")
+        if isinstance(message, AssistantMessage) and message.tool_calls:
+            chars += sum(len(tool_call.function.arguments) for tool_call in message.tool_calls)
+    return chars // 4
+
+
+def render_transcript(messages) -> str:
+    lines = []
+    for message in messages:
+        if isinstance(message, AssistantMessage) and message.tool_calls:
+            for tool_call in message.tool_calls:
+                function = tool_call.function
+                lines.append(f"assistant called {function.name}({function.arguments})")
+        if message.content:
+            lines.append(f"{type(message).__struct_config__.tag}: {message.content}")
+    return "\n".join(lines)
+
+
+# text of a tool result; non-text content (images, resources) is dropped
+def tool_result_text(result) -> str:
+    return "\n".join(item.text for item in result.content if item.type == "text")
+
+
+_log_encoder = msgspec.msgpack.Encoder()
+# canonical JSON (sorted keys) for cache keys, and a reusable decoder for tool args
+_key_encoder = msgspec.json.Encoder(order="sorted")
+_args_decoder = msgspec.json.Decoder()
 
 class MCPClient:
-    def __init__(self):
+    def __init__(self, cacheable_tools: Optional[dict[str, float]] = None):
         # Initialize session and client objects
         self.session: Optional[ClientSession] = None
         self.exit_stack = AsyncExitStack()
-        self.llm = OpenAI()
-        self.tools = []
-        self.messages = []
+        # one pooled HTTP/2 connection is reused across LLM calls
+        self.llm = AsyncOpenAI(
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=20),
+                timeout=httpx.Timeout(30.0, connect=3.0),
+            )
+        )
+        self.tools = ()
+        # tools the server marks read-only or idempotent, which are safe to retry
+        self._idempotent_tools = frozenset()
         self.logger = logger
+        self._tool_semaphore = asyncio.Semaphore(MAX_CONCURRENT_TOOL_CALLS)
+        self._llm_cache = LRUCache(LLM_CACHE_SIZE)
+        # tool name -> result TTL in seconds; only side-effect-free tools belong
+        # here, every other tool runs on each call
+        self.tool_cache_ttl = dict(cacheable_tools or {})
+        self._tool_cache = LRUCache(TOOL_CACHE_SIZE)
+        self._tool_inflight = {}
+        # new messages are appended to the session log by a background task
+        self._log_queue = asyncio.Queue()
+        self._log_writer_task = None
+        self._log_fp = None
+        self._session_ts = None
 
     # connect to the MCP server
     async def connect_to_server(self, server_script_path: str):
@@ -42,10 +198,21 @@ class MCPClient:
 
             await self.session.initialize()
 
+            if self._log_writer_task is None:
+                os.makedirs("conversations", exist_ok=True)
+                self._session_ts = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
+                self._log_fp = open(
+                    os.path.join("conversations", f"conversation_{self._session_ts}.msgpack"),
+                    "ab",
+                )
+                self._log_writer_task = asyncio.create_task(self._log_writer())
+
             self.logger.info("Connected to MCP server")
 
-            mcp_tools = await self.get_mcp_tools()
-            self.tools = [
+            mcp_tools = (await self.session.list_tools()).tools
+            # sorted by name and built once per connect so the tools prefix sent on
+            # every LLM call is byte-identical and can hit the provider's prompt cache
+            self.tools = tuple(
                 {
                     "type": "function",  # Add this required field
                     "function": {  # Wrap properties in a function object
@@ -54,8 +221,15 @@ class MCPClient:
                         "parameters": tool.inputSchema,  # Rename input_schema to parameters
                     }
                 }
+                for tool in sorted(mcp_tools, key=lambda tool: tool.name)
+            )
+
+            self._idempotent_tools = frozenset(
+                tool.name
                 for tool in mcp_tools
-            ]
+                if tool.annotations
+                and (tool.annotations.readOnlyHint or tool.annotations.idempotentHint)
+            )
 
             self.logger.info(
                 f"Available tools: {[tool['function']['name'] for tool in self.tools]}"
@@ -63,81 +237,131 @@ class MCPClient:
 
             return True
 
-        except Exception as e:
-            self.logger.error(f"Error connecting to MCP server: {e}")
-            traceback.print_exc()
-            raise
-
-    # get mcp tool list
-    async def get_mcp_tools(self):
-        try:
-            response = await self.session.list_tools()
-            return response.tools
-        except Exception as e:
-            self.logger.error(f"Error getting MCP tools: {e}")
+        except Exception:
+            self.logger.exception("Error connecting to MCP server")
             raise
 
     # process query
     async def process_query(self, query: str):
         try:
             self.logger.info(f"Processing query: {query}")
-            user_message = {"role": "user", "content": query}
-            self.messages = [user_message]
+            conversation = Conversation([SYSTEM_MESSAGE])
+            conversation.append(UserMessage(query))
 
             while True:
-                response = await self.call_llm()
+                # tool calls are dispatched while the rest of the response streams in
+                pending = []
+                try:
+                    assistant_message = await self.call_llm(
+                        conversation,
+                        on_tool_call=lambda tool_call: pending.append(
+                            asyncio.ensure_future(self.call_tool(tool_call))
+                        )
+                    )
+                except Exception:
+                    for task in pending:
+                        task.cancel()
+                    raise
+                conversation.append(assistant_message)
+                self.log_conversation(conversation)
 
                 # the response is a text message
-                if not hasattr(response, 'choices') or not response.choices[0].message.tool_calls:
-                    assistant_message = {
-                        "role": "assistant",
-                        "content": response.choices[0].message.content,
-                    }
-                    self.messages.append(assistant_message)
-                    await self.log_conversation()
+                if not pending:
                     break
 
-                # the response is a tool call
-                message = response.choices[0].message
-                assistant_message = {
-                    "role": "assistant",
-                    "content": message.content,
-                    "tool_calls": message.tool_calls
-                }
-                self.messages.append(assistant_message)
-                await self.log_conversation()
-
-                for tool_call in message.tool_calls:
+                # the response is a tool call; collect results in call order
+                results = await asyncio.gather(*pending, return_exceptions=True)
+                for tool_call, result in zip(assistant_message.tool_calls, results):
                     tool_name = tool_call.function.name
-                    tool_args = json.loads(tool_call.function.arguments)
-                    tool_use_id = tool_call.id
-                    self.logger.info(
-                        f"Calling tool {tool_name} with args {tool_args}"
-                    )
-                    try:
-                        result = await self.session.call_tool(tool_name, tool_args)
-                        self.logger.info(f"Tool {tool_name} result: {result}...")
-                        self.messages.append(
-                            {
-                                "role": "tool",
-                                "tool_call_id": tool_use_id,
-                                "content": result.content,
-                            }
-                        )
-                        await self.log_conversation()
-                    except Exception as e:
-                        self.logger.error(f"Error calling tool {tool_name}: {e}")
-                        raise
+                    if isinstance(result, Exception):
+                        self.logger.error(f"Error calling tool {tool_name}: {result}")
+                        content = f"Error calling tool {tool_name}: {result}"
+                    else:
+                        content = tool_result_text(result)
+                    conversation.append(ToolMessage(tool_call.id, content))
+                self.log_conversation(conversation)
+                await self.compact_messages(conversation)
 
-            return self.messages
+            # the system prompt is internal to the client and not part of the result;
+            # the conversation ends here, so its payload dicts can go to the caller
+            return [
+                payload
+                for message, payload in zip(conversation.messages, conversation.payload)
+                if message is not SYSTEM_MESSAGE
+            ]
 
         except Exception as e:
             self.logger.error(f"Error processing query: {e}")
             raise
 
-    # call llm
-    async def call_llm(self):
+    # call a single tool, reusing cached or in-flight results for identical calls
+    async def call_tool(self, tool_call):
+        tool_name = tool_call.function.name
+        tool_args = _args_decoder.decode(tool_call.function.arguments)
+        ttl = self.tool_cache_ttl.get(tool_name)
+        if not ttl:
+            return await self._execute_tool(tool_name, tool_args)
+
+        key = (tool_name, _key_encoder.encode(tool_args))
+        cached = self._tool_cache.get(key)
+        if cached is not None:
+            self.logger.info(f"Using cached result for tool {tool_name}")
+            return cached
+
+        inflight = self._tool_inflight.get(key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._execute_tool(tool_name, tool_args))
+            self._tool_inflight[key] = inflight
+            inflight.add_done_callback(partial(self._store_tool_result, key, ttl))
+        return await asyncio.shield(inflight)
+
+    # execute a tool on the server, bounded by the concurrency semaphore; calls
+    # to idempotent tools that time out are retried with randomized exponential
+    # backoff (a timed-out call may already have run, so others are not retried)
+    async def _execute_tool(self, tool_name, tool_args):
+        attempts = TOOL_CALL_ATTEMPTS if tool_name in self._idempotent_tools else 1
+        for attempt in range(1, attempts + 1):
+            try:
+                async with self._tool_semaphore:
+                    self.logger.info(f"Calling tool {tool_name} with args {tool_args}")
+                    result = await self.session.call_tool(
+                        tool_name,
+                        tool_args,
+                        read_timeout_seconds=timedelta(seconds=TOOL_CALL_TIMEOUT),
+                    )
+                break
+            except McpError as e:
+                if e.error.code != httpx.codes.REQUEST_TIMEOUT or attempt == attempts:
+                    raise
+                delay = random.uniform(0.1, min(4.0, 0.1 * 2**attempt))
+                self.logger.warning(
+                    f"Tool {tool_name} failed ({e!r}), retrying in {delay:.2f}s"
+                )
+                await asyncio.sleep(delay)
+        self.logger.info(f"Tool {tool_name} result: {result}...")
+        return result
+
+    def _store_tool_result(self, key, ttl, future):
+        self._tool_inflight.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        result = future.result()
+        if not result.isError:
+            self._tool_cache.set(key, result, ttl=ttl)
+
+    # call llm, streaming the response and handing each tool call to
+    # on_tool_call as soon as it is complete; returns the assistant message
+    async def call_llm(self, conversation, on_tool_call=None):
         try:
+            cache_key = self._llm_cache_key(conversation.messages)
+            cached = self._llm_cache.get(cache_key)
+            if cached is not None:
+                self.logger.info("Using cached LLM response")
+                if on_tool_call is not None:
+                    for tool_call in cached.tool_calls or ():
+                        on_tool_call(tool_call)
+                return cached
+
             self.logger.info("Calling LLM")
             # return self.llm.messages.create(
             #     model="claude-3-5-haiku-20241022",
@@ -145,73 +369,178 @@ class MCPClient:
                 # messages=self.messages,
                 # tools=self.tools,
             # )
-            return self.llm.chat.completions.create(
-                model="gpt-4o",
+            stream = await self.llm.chat.completions.create(
+                model=LLM_MODEL,
                 max_tokens=1000,
-                messages=self.messages,
+                messages=conversation.payload,
                 tools=self.tools,
+                stream=True,
             )
+
+            content = []
+            # (id, name, argument fragments) per tool call as it streams in
+            partial_calls = []
+            tool_calls = []
+            finish_reason = None
+
+            def complete_tool_call():
+                call_id, name, arguments = partial_calls[-1]
+                tool_call = ToolCall(call_id, FunctionCall(name, "".join(arguments)))
+                tool_calls.append(tool_call)
+                if on_tool_call is not None:
+                    on_tool_call(tool_call)
+
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content.append(delta.content)
+                for tool_call_delta in delta.tool_calls or []:
+                    function = tool_call_delta.function
+                    # tool calls stream one after another, so a new index means
+                    # the previous call's arguments are complete
+                    if tool_call_delta.index == len(partial_calls):
+                        if partial_calls:
+                            complete_tool_call()
+                        partial_calls.append(
+                            (tool_call_delta.id, function.name if function else "", [])
+                        )
+                    elif tool_call_delta.index != len(partial_calls) - 1:
+                        self.logger.warning(
+                            f"Dropping out-of-order tool call delta "
+                            f"(index {tool_call_delta.index}, "
+                            f"expected {len(partial_calls)})"
+                        )
+                        continue
+                    if function and function.arguments:
+                        partial_calls[-1][2].append(function.arguments)
+            # a response cut short (e.g. by max_tokens) may end in a half-written
+            # tool call, which is dropped, and is never cached
+            complete = finish_reason in ("stop", "tool_calls")
+            if partial_calls:
+                if complete:
+                    complete_tool_call()
+                else:
+                    self.logger.warning(
+                        f"Dropping incomplete tool call {partial_calls[-1][1]} "
+                        f"(finish_reason={finish_reason})"
+                    )
+
+            assistant_message = AssistantMessage(
+                "".join(content) if content else None,
+                tuple(tool_calls) if tool_calls else msgspec.UNSET,
+            )
+            if complete:
+                self._llm_cache.set(cache_key, assistant_message)
+            return assistant_message
         except Exception as e:
             self.logger.error(f"Error calling LLM: {e}")
             raise
 
+    # collapse older tool rounds into a summary so each request's prefill stays
+    # bounded; the user turn and the latest tool round are kept verbatim
+    async def compact_messages(self, conversation):
+        messages = conversation.messages
+        if estimate_tokens(messages) <= HISTORY_TOKEN_LIMIT:
+            return
+
+        last_user = max(
+            i for i, message in enumerate(messages) if isinstance(message, UserMessage)
+        )
+        last_round = max(
+            i
+            for i, message in enumerate(messages)
+            if isinstance(message, AssistantMessage)
+        )
+        older = messages[last_user + 1 : last_round]
+        if not older:
+            return
+
+        try:
+            self.logger.info(f"Summarizing {len(older)} older messages")
+            response = await self.llm.chat.completions.create(
+                model=SUMMARY_MODEL,
+                max_tokens=500,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": (
+                            "Summarize this exchange between an assistant and its "
+                            "tools. Keep every fact needed to answer the user."
+                        ),
+                    },
+                    {"role": "user", "content": render_transcript(older)},
+                ],
+            )
+        except Exception as e:
+            # keep the full history rather than failing the query
+            self.logger.error(f"Error summarizing messages: {e}")
+            return
+
+        summary = response.choices[0].message.content
+        if not summary:
+            self.logger.error("Error summarizing messages: empty summary")
+            return
+
+        conversation.remove(last_user + 1, last_round)
+        conversation.insert(
+            last_user + 1, SystemMessage("Summary of earlier tool calls: " + summary)
+        )
+        self.log_conversation(conversation)
+
+    # exact-match key for the llm response cache
+    def _llm_cache_key(self, messages):
+        payload = _key_encoder.encode(
+            {"model": LLM_MODEL, "tools": self.tools, "messages": messages}
+        )
+        return blake2b(payload, digest_size=16).hexdigest()
+
     # cleanup
     async def cleanup(self):
         try:
+            if self._log_writer_task is not None:
+                await self._log_queue.join()
+                self._log_writer_task.cancel()
+                self._log_writer_task = None
+                self._log_fp.close()
+                self._log_fp = None
             await self.exit_stack.aclose()
+            await self.llm.close()
             self.logger.info("Disconnected from MCP server")
-        except Exception as e:
-            self.logger.error(f"Error during cleanup: {e}")
-            traceback.print_exc()
+        except Exception:
+            self.logger.exception("Error during cleanup")
             raise
 
-    async def log_conversation(self):
-        os.makedirs("conversations", exist_ok=True)
-
-        serializable_conversation = []
+    # hand the conversation's records added since the last call to the writer
+    def log_conversation(self, conversation):
+        if conversation.log_tail:
+            self._log_queue.put_nowait(conversation.log_tail)
+            conversation.log_tail = []
 
-        for message in self.messages:
+    async def _log_writer(self):
+        while True:
+            records = await self._log_queue.get()
+            batches = 1
+            while not self._log_queue.empty():
+                records.extend(self._log_queue.get_nowait())
+                batches += 1
             try:
-                serializable_message = {"role": message["role"]}
-                
-                # Handle content
-                if "content" in message:
-                    serializable_message["content"] = message["content"]
-                
-                # Handle tool_calls if present
-                if "tool_calls" in message:
-                    serializable_message["tool_calls"] = []
-                    for tool_call in message["tool_calls"]:
-                        if hasattr(tool_call, "to_dict"):
-                            serializable_message["tool_calls"].append(tool_call.to_dict())
-                        elif isinstance(tool_call, dict):
-                            serializable_message["tool_calls"].append(tool_call)
-                        else:
-                            serializable_message["tool_calls"].append({
-                                "id": tool_call.id,
-                                "function": {
-                                    "name": tool_call.function.name,
-                                    "arguments": tool_call.function.arguments
-                                }
-                            })
-                
-                # Handle tool_call_id if present (for tool responses)
-                if "tool_call_id" in message:
-                    serializable_message["tool_call_id"] = message["tool_call_id"]
-
-                serializable_conversation.append(serializable_message)
-            except Exception as e:
-                self.logger.error(f"Error processing message: {str(e)}")
-                self.logger.debug(f"Message content: {message}")
-                raise
-
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        filepath = os.path.join("conversations", f"conversation_{timestamp}.json")
+                await asyncio.to_thread(self._write_conversation, records)
+            except Exception:
+                pass  # already logged by _write_conversation
+            finally:
+                for _ in range(batches):
+                    self._log_queue.task_done()
 
+    def _write_conversation(self, records):
         try:
-            with open(filepath, "w") as f:
-                json.dump(serializable_conversation, f, indent=2, default=str)
+            self._log_fp.write(
+                b"".join(encode_frame(_log_encoder.encode(record)) for record in records)
+            )
+            self._log_fp.flush()
         except Exception as e:
             self.logger.error(f"Error writing conversation to file: {str(e)}")
-            self.logger.debug(f"Serializable conversation: {serializable_conversation}")
-            raise
\ No newline at end of file
+            self.logger.debug(f"Conversation records: {records}")
+            raise
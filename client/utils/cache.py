@@ -0,0 +1,32 @@
+from collections import OrderedDict
+import time
+
+
+class LRUCache:
+    """Small in-memory cache that evicts the least recently used entry.
+
+    Entries may carry a time-to-live in seconds; expired entries are dropped
+    lazily when they are looked up.
+    """
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value, expires_at = self._data[key]
+        except KeyError:
+            return default
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float | None = None):
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
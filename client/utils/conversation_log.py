@@ -0,0 +1,30 @@
+import struct
+import msgspec
+
+# Conversation logs are a stream of frames: a 4-byte big-endian payload
+# length followed by one MessagePack-encoded message record. New messages
+# are appended as they arrive and readers rebuild the conversation by
+# streaming the frames back.
+_HEADER = struct.Struct(">I")
+
+
+def encode_frame(payload: bytes) -> bytes:
+    return _HEADER.pack(len(payload)) + payload
+
+
+def iter_frames(fp):
+    while True:
+        header = fp.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return
+        (size,) = _HEADER.unpack(header)
+        payload = fp.read(size)
+        if len(payload) < size:
+            # trailing frame cut short by an interrupted write
+            return
+        yield payload
+
+
+def read_conversation(path: str) -> list:
+    with open(path, "rb") as fp:
+        return [msgspec.msgpack.decode(payload) for payload in iter_frames(fp)]
@@ -1,24 +1,28 @@
 from mcp.server.fastmcp import FastMCP
-from openai import OpenAI
+from mcp.types import ToolAnnotations
+from openai import AsyncOpenAI
 
 mcp = FastMCP("Chat bot")
+# shared across tool calls so the HTTP connection to OpenAI is kept alive
+client = AsyncOpenAI()
+MODEL = "gpt-4o-mini"
+# identical on every call so the provider can reuse its prompt cache
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a AI assistant will answer for users questions"
+}
 
 print("Mcp>>>",mcp.name)
 
-@mcp.tool()
-def chatbot(query:str)->str:
+@mcp.tool(annotations=ToolAnnotations(readOnlyHint=True))
+async def chatbot(query:str)->str:
     """
     Generate a answer for user asked query
     """
-    client = OpenAI()
-
-    completion = client.chat.completions.create(
-        model="gpt-4o",
+    completion = await client.chat.completions.create(
+        model=MODEL,
         messages=[
-            {
-                "role": "system",
-                "content": "You are a AI assistant will answer for users questions"
-            },
+            SYSTEM_MESSAGE,
             {
                 "role": "user",
                 "content": query
@@ -30,4 +34,11 @@ def chatbot(query:str)->str:
     return completion.choices[0].message.content
 
 if __name__ == "__main__":
-    mcp.run(transport="stdio")
\ No newline at end of file
+    try:
+        import asyncio
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    mcp.run(transport="stdio")